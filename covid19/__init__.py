@@ -1,9 +1,27 @@
-from dagster import Definitions, load_assets_from_modules
+from dagster import (
+    Definitions, 
+    define_asset_job, 
+    load_assets_from_modules, 
+    multiprocess_executor
+)
 
 from . import assets
 
 all_assets = load_assets_from_modules([assets])
 
+# the fact assets only depend on the dimensions, so download them in parallel
+fact_job = define_asset_job(
+    name="fact_ingest",
+    selection=[
+        assets.pull_deaths,
+        assets.pull_vaccinations,
+        assets.pull_hospital_admissions,
+        assets.pull_excess_mortality,
+    ],
+    executor_def=multiprocess_executor.configured({"max_concurrent": 4}),
+)
+
 defs = Definitions(
     assets=all_assets,
+    jobs=[fact_job],
 )
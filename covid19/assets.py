@@ -1,10 +1,23 @@
-import pandas as pd
+import csv
+import functools
+import hashlib
+import io
+import itertools
+import json
 import os
-
-from sqlalchemy import create_engine
-from sqlalchemy.schema import CreateSchema
+import queue
+import tempfile
+import threading
+from typing import Optional
 from urllib.parse import quote_plus
-from dagster import asset
+
+import ijson
+import pandas as pd
+import pyarrow as pa
+import pyarrow.json as pa_json
+import requests
+from dagster import AssetOut, MaterializeResult, asset, multi_asset
+from sqlalchemy import create_engine, text
 
 DRIVER = os.getenv("DRIVER")
 SERVER = os.getenv("SERVER")
@@ -12,6 +25,19 @@ DATABASE = os.getenv("DATABASE")
 USER = os.getenv("USER")
 PASSWORD = os.getenv("PASSWORD")
 
+# load tables with BULK INSERT from a folder that the database server can read
+USE_BULK = os.getenv("USE_BULK") == "1"
+BULK_STAGING_DIR = os.getenv("BULK_STAGING_DIR")
+
+# folder keeping the last OWID responses, revalidated with their ETag / Last-Modified
+OWID_CACHE_DIR = os.getenv("OWID_CACHE_DIR", os.path.join("model", "_owid_cache"))
+
+# connect and read timeouts in seconds of the OWID downloads
+OWID_TIMEOUT = (10, 120)
+
+# op tag shared by every asset downloading from the OWID server
+OWID_OP_TAGS = {"dagster/concurrency_key": "owid_http"}
+
 connection_string = (
     f'Driver={DRIVER};'
     f'SERVER={SERVER};'
@@ -22,12 +48,42 @@ connection_string = (
 )
 
 connection_uri = f"mssql+pyodbc:///?odbc_connect={quote_plus(connection_string)}"
-engine = create_engine(connection_uri, fast_executemany=True)
-conn = engine.connect()
+
+@functools.lru_cache(maxsize=1)
+def get_engine():
+    """
+    Create the database engine on first use, so assets without sql never connect.
+    """
+    return create_engine(
+        connection_uri, 
+        fast_executemany=True, 
+        pool_pre_ping=True, 
+        pool_recycle=1800
+    )
 
 def db_create_schema(schema_name:str):
-    if schema_name not in conn.dialect.get_schema_names(conn):
-        conn.execute(CreateSchema(schema_name))
+    """
+    Create a schema in the database if it does not exist yet.
+    """
+    # check and create in one batch, the check is not atomic so a parallel step
+    # may create the schema in between, which raises error 2714 and is ignored
+    with get_engine().begin() as conn:
+        conn.execute(
+            text(
+                "set nocount on; "
+                "if not exists (select 1 from sys.schemas where name = :schema) "
+                "begin "
+                "declare @sql nvarchar(max) = N'create schema ' + quotename(:schema); "
+                "begin try "
+                "exec (@sql); "
+                "end try "
+                "begin catch "
+                "if error_number() <> 2714 throw; "
+                "end catch "
+                "end"
+            ),
+            {"schema": schema_name}
+        )
 
 def db_run_query(
         query_string:str,
@@ -35,14 +91,66 @@ def db_run_query(
     ):
     """
     Read data from the database, and assign the output as a dataframe.
+    Statements without a result set are executed when return_table is False.
     """
     if return_table:
         df = pd.read_sql( 
             sql=query_string, 
-            con=engine
+            con=get_engine(), 
+            dtype_backend="pyarrow"
         )
         return df
 
+    with get_engine().begin() as conn:
+        conn.execute(text(query_string))
+
+def _bulk_insert(
+        df:pd.DataFrame, 
+        table_name:str, 
+        schema:str, 
+        insert_type="replace"
+    ):
+    """
+    Write data from a dataframe to the database through a staged BULK INSERT.
+    """
+    if not BULK_STAGING_DIR:
+        raise ValueError("BULK_STAGING_DIR must be set to a folder the database server can read when USE_BULK=1")
+
+    # csv cannot tell empty strings from nulls, which keepnulls loads as null
+    for column in df.columns:
+        if pd.api.types.is_string_dtype(df[column]) and (df[column] == "").any():
+            raise ValueError(f"Column {column} holds empty strings, which BULK INSERT would load as null")
+
+    # bit columns only accept 1 and 0, copy the frame only when there are some
+    bool_columns = [column for column in df.columns if pd.api.types.is_bool_dtype(df[column])]
+    df_rows = df
+    if bool_columns:
+        df_rows = df.astype({column: "int8[pyarrow]" for column in bool_columns})
+
+    # a unique file name so overlapping loads of the same table do not collide
+    fd, path = tempfile.mkstemp(dir=BULK_STAGING_DIR, prefix=f"{schema}.{table_name}.", suffix=".csv")
+    os.close(fd)
+    try:
+        df_rows.to_csv(path, quoting=csv.QUOTE_MINIMAL, lineterminator="\n", header=False, index=False)
+        with get_engine().begin() as conn:
+            # let pandas create or replace the table, then load the rows natively
+            df.head(0).to_sql(
+                name=table_name, 
+                schema=schema, 
+                con=conn, 
+                if_exists=insert_type, 
+                index=False
+            )
+            # escape the path for the sql literal and for the bind parameters of text()
+            sql_path = path.replace("'", "''").replace(":", "\\:")
+            conn.execute(text(
+                f"bulk insert [{schema}].[{table_name}] from '{sql_path}' "
+                "with (format = 'CSV', fieldquote = '\"', rowterminator = '0x0a', codepage = '65001', "
+                "keepnulls, tablock, batchsize = 100000)"
+            ))
+    finally:
+        os.remove(path)
+
 def write_data_to_db(
         df:pd.DataFrame, 
         table_name:str, 
@@ -53,177 +161,439 @@ def write_data_to_db(
     """
     Write data from a dataframe to the database.
     """
-    df.to_sql(
-        name=table_name, 
-        schema=schema, 
-        con=engine, 
-        if_exists=insert_type, 
-        chunksize=chunks, 
-        index=False
-    )
+    if USE_BULK:
+        _bulk_insert(df=df, table_name=table_name, schema=schema, insert_type=insert_type)
+        return df
+
+    with get_engine().begin() as conn:
+        df.to_sql(
+            name=table_name, 
+            schema=schema, 
+            con=conn, 
+            if_exists=insert_type, 
+            chunksize=chunks, 
+            index=False
+        )
     return df
 
-@asset
-def pull_cases() -> None:
+class _ChunkStream(io.RawIOBase):
     """
-    Get the historical data of COVID-19 cases and tests by country.
+    Read-only file object over an iterator of byte chunks.
     """
 
-    # read data from api
-    url = "https://covid.ourworldindata.org/data/internal/megafile--cases-tests.json"
-    df = pd.read_json(url)
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._chunk = memoryview(b"")
 
-    # rename the country column name
-    df.rename(columns={"location":"country"}, inplace=True)
+    def readable(self) -> bool:
+        return True
 
-    # create a schema if not exists
-    db_create_schema("fact")
+    def readinto(self, b) -> int:
+        while not self._chunk:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._chunk = memoryview(chunk)
+        size = min(len(b), len(self._chunk))
+        b[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
 
-    # write data to database
-    write_data_to_db(df=df, table_name="daily_cases", schema="fact")
+# number of records converted to arrow at a time when parsing json arrays
+JSON_BATCH_SIZE = 50_000
 
-@asset(deps=[pull_cases])
-def generate_calendar() -> None:
+def _read_json_array(stream:io.BufferedReader) -> pa.Table:
     """
-    Create a date calendar based on the daily_cases.
+    Parse a JSON array of records incrementally into an Arrow table.
     """
+    batches = []
+    records = []
+    for record in ijson.items(stream, "item", use_float=True):
+        records.append(record)
+        if len(records) == JSON_BATCH_SIZE:
+            batches.append(pa.Table.from_struct_array(pa.array(records)))
+            records = []
+    if records:
+        batches.append(pa.Table.from_struct_array(pa.array(records)))
+
+    # columns may be all null or integral in some batches only
+    table = pa.concat_tables(batches, promote_options="permissive")
+
+    # arrow does not infer timestamps from python strings
+    if "date" in table.column_names:
+        table = table.set_column(
+            table.column_names.index("date"), 
+            "date", 
+            table["date"].cast(pa.timestamp("s"))
+        )
+    return table
 
-    # get the unique dates
-    df = db_run_query("select distinct [date] from fact.daily_cases")
-
-    # add more attributes
-    df["year"] = df["date"].dt.year
-    df["month"] = df["date"].dt.month
-    df["day"] = df["date"].dt.day
-
-    # create a schema if not exists
-    db_create_schema("dim")
-
-    # write data to database
-    write_data_to_db(df=df, table_name="calendar", schema="dim")
+# largest number of leading bytes read to tell the layout of a JSON file
+JSON_LAYOUT_HEAD_SIZE = 1<<20
 
-@asset(deps=[pull_cases])
-def generate_countries() -> None:
+def _json_layout(head:bytes) -> Optional[str]:
     """
-    Create a country table based on the daily_cases.
+    Tell from the first bytes of a JSON file whether it holds an array of records,
+    a column-oriented object or line-delimited records.
+    Return None when the bytes end before the layout can be told.
     """
+    head = head.lstrip()
+    if not head:
+        return None
+    if head[:1] == b"[":
+        return "records"
+    if head[:1] != b"{":
+        raise ValueError(f"Unsupported JSON layout starting with {head[:20]!r}")
+
+    # a column-oriented object holds an array or an object under its first key
+    try:
+        for prefix, event, _ in ijson.parse(io.BytesIO(head), multiple_values=True):
+            if prefix:
+                return "columns" if event in ("start_array", "start_map") else "lines"
+    except ijson.IncompleteJSONError:
+        pass
+    return None
+
+def _read_json_head(stream:io.BufferedReader) -> tuple[str, io.BufferedReader]:
+    """
+    Read a JSON file object until its layout can be told.
+    Return the layout with a file object reading again from the start.
+    """
+    head = b""
+    layout = None
+    while layout is None:
+        chunk = stream.read1(1<<16)
+        if not chunk or len(head) >= JSON_LAYOUT_HEAD_SIZE:
+            raise ValueError(f"Could not tell the JSON layout from {head[:20]!r}")
+        head += chunk
+        layout = _json_layout(head)
+
+    # put the head back in front of the rest of the stream
+    rest = iter(lambda: stream.read1(1<<20), b"")
+    return layout, io.BufferedReader(_ChunkStream(itertools.chain([head], rest)), buffer_size=1<<20)
+
+def _read_json_stream(
+        stream:io.BufferedReader, 
+        size:Optional[int] = None
+    ) -> pd.DataFrame:
+    """
+    Parse a JSON file object into a dataframe with Arrow-backed dtypes.
+    The size in bytes, when known, spreads the blocks of the Arrow reader over all cores.
+    """
+    layout, stream = _read_json_head(stream)
+
+    # column-oriented objects cannot be split into records while streaming
+    if layout == "columns":
+        df = pd.read_json(stream, dtype_backend="pyarrow")
+        return df.reset_index(drop=True)
+
+    # arrow only reads line-delimited json, json arrays are parsed record by record
+    if layout == "records":
+        table = _read_json_array(stream)
+    else:
+        block_size = 8<<20
+        if size:
+            block_size = max(1<<20, size // (os.cpu_count() or 1))
+
+        table = pa_json.read_json(
+            stream,
+            read_options=pa_json.ReadOptions(use_threads=True, block_size=block_size)
+        )
 
-    # get the unique countries
-    df = db_run_query("select distinct [country] from fact.daily_cases")
+    # keep arrow types so nullable integers do not widen to float64
+    return table.to_pandas(split_blocks=True, self_destruct=True, types_mapper=pd.ArrowDtype)
 
-    # create a schema if not exists
-    db_create_schema("dim")
+def _download_and_parse(
+        response:requests.Response, 
+        body_path:str, 
+        size:Optional[int] = None
+    ) -> pd.DataFrame:
+    """
+    Parse a response while a background thread keeps downloading it into the cache.
+    """
+    chunks = queue.Queue(maxsize=8)
+    parsed = threading.Event()
+    aborted = threading.Event()
+    errors = []
+
+    # download next to the cache entry so a failed transfer never replaces it,
+    # under a unique name so overlapping runs do not share a partial file
+    part = tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(body_path), 
+        suffix=".part", 
+        delete=False
+    )
 
-    # write data to database
-    write_data_to_db(df=df, table_name="country", schema="dim")
+    def put(chunk):
+        # stop handing chunks over once the parser is done with the stream
+        while not parsed.is_set():
+            try:
+                chunks.put(chunk, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def download():
+        try:
+            with part as f:
+                for chunk in response.iter_content(chunk_size=1<<20):
+                    f.write(chunk)
+                    put(chunk)
+        except Exception as e:
+            # closing the response on a parse error also fails the download, keep the parse error
+            if not aborted.is_set():
+                errors.append(e)
+        finally:
+            put(None)
+
+    thread = threading.Thread(target=download, daemon=True)
+    thread.start()
+
+    df = None
+    parse_error = None
+    try:
+        with io.BufferedReader(_ChunkStream(iter(chunks.get, None)), buffer_size=1<<20) as stream:
+            df = _read_json_stream(stream, size=size)
+    except Exception as e:
+        parse_error = e
+    finally:
+        parsed.set()
+        if df is None:
+            # abort the download when parsing failed
+            aborted.set()
+            response.close()
+        thread.join()
+        if df is None or errors:
+            part.close()
+            os.remove(part.name)
+
+    # a dropped connection reaches the parser as truncated json, raise the cause
+    if errors:
+        raise errors[0] from parse_error
+    if parse_error is not None:
+        raise parse_error
+    os.replace(part.name, body_path)
+    return df
 
-@asset(deps=[generate_calendar, generate_countries])
-def pull_deaths() -> None:
+def _read_json_url(url:str) -> tuple[pd.DataFrame, dict]:
+    """
+    Read a JSON file from a url through the local cache, and parse it with Arrow-backed dtypes.
+    The cached file is reused when the server reports it unchanged.
+    Return the dataframe with the metadata of the response.
     """
-    Get the historical data of COVID-19 deaths by country.
+    os.makedirs(OWID_CACHE_DIR, exist_ok=True)
+    key = hashlib.sha256(url.encode()).hexdigest()
+    body_path = os.path.join(OWID_CACHE_DIR, f"{key}.json")
+    headers_path = os.path.join(OWID_CACHE_DIR, f"{key}.headers.json")
+
+    # validators of the cached response, if any
+    cached = {}
+    if os.path.exists(body_path) and os.path.exists(headers_path):
+        with open(headers_path) as f:
+            cached = json.load(f)
+
+    request_headers = {}
+    if "ETag" in cached:
+        request_headers["If-None-Match"] = cached["ETag"]
+    if "Last-Modified" in cached:
+        request_headers["If-Modified-Since"] = cached["Last-Modified"]
+
+    with requests.get(url, headers=request_headers, stream=True, timeout=OWID_TIMEOUT) as response:
+        cache_hit = response.status_code == 304
+        if cache_hit:
+            with open(body_path, "rb", buffering=1<<20) as stream:
+                df = _read_json_stream(stream, size=os.path.getsize(body_path))
+        else:
+            response.raise_for_status()
+
+            # the length of an encoded body is not the size of the decoded json
+            size = None
+            if response.headers.get("Content-Encoding", "identity") == "identity":
+                size = int(response.headers.get("Content-Length", 0))
+            df = _download_and_parse(response, body_path, size=size)
+
+            cached = {
+                name: response.headers[name] 
+                for name in ("ETag", "Last-Modified", "Content-Length") 
+                if name in response.headers
+            }
+            # replace the validators atomically so a concurrent run never reads half a file
+            with tempfile.NamedTemporaryFile(
+                "w", 
+                dir=OWID_CACHE_DIR, 
+                suffix=".part", 
+                delete=False
+            ) as f:
+                json.dump(cached, f)
+            os.replace(f.name, headers_path)
+
+    metadata = {
+        "url": url,
+        "cache_hit": cache_hit,
+        "size_bytes": os.path.getsize(body_path),
+        "etag": cached.get("ETag", ""),
+        "last_modified": cached.get("Last-Modified", ""),
+        "content_length": cached.get("Content-Length", ""),
+    }
+    return df, metadata
+
+@asset(op_tags=OWID_OP_TAGS)
+def pull_cases() -> MaterializeResult:
+    """
+    Get the historical data of COVID-19 cases and tests by country.
     """
 
     # read data from api
-    url = "https://covid.ourworldindata.org/data/internal/megafile--deaths.json"
-    df = pd.read_json(url)
-
-    # drop continent column
-    df.drop(columns=["continent"], errors="ignore", inplace=True)
+    url = "https://covid.ourworldindata.org/data/internal/megafile--cases-tests.json"
+    df, source_metadata = _read_json_url(url)
 
     # rename the country column name
     df.rename(columns={"location":"country"}, inplace=True)
 
-    # read dimension tables
-    df_date = db_run_query("select distinct [date] from dim.calendar")
-    df_country = db_run_query("select distinct [country] from dim.country")
-
-    # inner join to make sure foreign keys
-    df = (
-        df
-        .merge(df_date)
-        .merge(df_country)
-    )
+    # create a schema if not exists
+    db_create_schema("fact")
 
     # write data to database
-    write_data_to_db(df=df, table_name="daily_deaths", schema="fact")
+    write_data_to_db(df=df, table_name="daily_cases", schema="fact")
 
-@asset(deps=[generate_calendar, generate_countries])
-def pull_vaccinations() -> None:
+    # record the downloaded file to audit the cache
+    return MaterializeResult(metadata=source_metadata)
+
+@multi_asset(
+    outs={
+        "generate_calendar": AssetOut(description="Create a date calendar based on the daily_cases."),
+        "generate_countries": AssetOut(description="Create a country table based on the daily_cases."),
+    },
+    deps=[pull_cases]
+)
+def generate_dimensions() -> tuple[pd.DataFrame, pd.DataFrame]:
     """
-    Get the historical data of COVID-19 vaccinations by country.
+    Create the date calendar and the country table based on the daily_cases.
     """
 
-    # read data from api
-    url = "https://covid.ourworldindata.org/data/internal/megafile--vaccinations.json"
-    df = pd.read_json(url)
+    # create a schema if not exists
+    db_create_schema("dim")
 
-    # rename the country column name
-    df.rename(columns={"location":"country"}, inplace=True)
+    # get the unique dates and countries in one scan, without leaving the database,
+    # without row count messages so that errors of any statement reach pyodbc
+    db_run_query(
+        """
+        set nocount on;
+
+        drop table if exists #keys;
+        drop table if exists dim.calendar;
+        drop table if exists dim.country;
+
+        select [date], [country], grouping([date]) as is_country
+        into #keys
+        from fact.daily_cases
+        group by grouping sets (([date]), ([country]));
+
+        select 
+            [date], 
+            year([date]) as [year], 
+            month([date]) as [month], 
+            day([date]) as [day]
+        into dim.calendar
+        from #keys
+        where is_country = 0;
+
+        select [country]
+        into dim.country
+        from #keys
+        where is_country = 1;
+
+        drop table #keys;
+        """,
+        return_table=False
+    )
 
-    # read dimension tables
-    df_date = db_run_query("select distinct [date] from dim.calendar")
-    df_country = db_run_query("select distinct [country] from dim.country")
+    # read back the keys for the fact tables
+    df_date = db_run_query("select [date] from dim.calendar")
+    df_country = db_run_query("select [country] from dim.country")
+    df_country["country"] = df_country["country"].astype("category")
+    return df_date, df_country
 
-    # inner join to make sure foreign keys
-    df = (
-        df
-        .merge(df_date)
-        .merge(df_country)
-    )
+# common type of the date keys, the api and the database return different units
+DATE_KEY_TYPE = pd.ArrowDtype(pa.timestamp("ns"))
 
-    # write data to database
-    write_data_to_db(df=df, table_name="daily_vaccinations", schema="fact")
+def _foreign_key_mask(
+        df:pd.DataFrame, 
+        df_date:pd.DataFrame, 
+        df_country:pd.DataFrame
+    ) -> pd.Series:
+    """
+    Flag the rows whose date and country exist in the dimension tables.
+    """
+    return (
+        df["date"].astype(DATE_KEY_TYPE).isin(df_date["date"].astype(DATE_KEY_TYPE))
+        & df["country"].isin(df_country["country"])
+    )
 
-@asset(deps=[generate_calendar, generate_countries])
-def pull_hospital_admissions() -> None:
+def _make_pull_asset(
+        name:str, 
+        url:str, 
+        table_name:str, 
+        description:str, 
+        drop_continent=False
+    ):
     """
-    Get the historical data of COVID-19 hospital patients and admissions by country.
+    Create an asset pulling a fact table from the api, keeping the rows found in the dimension tables.
     """
 
-    # read data from api
-    url = "https://covid.ourworldindata.org/data/internal/megafile--hospital-admissions.json"
-    df = pd.read_json(url)
+    @asset(name=name, description=description, op_tags=OWID_OP_TAGS)
+    def _pull_asset(
+            generate_calendar:pd.DataFrame, 
+            generate_countries:pd.DataFrame
+        ) -> MaterializeResult:
 
-    # rename the country column name
-    df.rename(columns={"location":"country"}, inplace=True)
+        # read data from api
+        df, source_metadata = _read_json_url(url)
 
-    # read dimension tables
-    df_date = db_run_query("select distinct [date] from dim.calendar")
-    df_country = db_run_query("select distinct [country] from dim.country")
+        # drop continent column
+        if drop_continent:
+            df.drop(columns=["continent"], errors="ignore", inplace=True)
 
-    # inner join to make sure foreign keys
-    df = (
-        df
-        .merge(df_date)
-        .merge(df_country)
-    )
+        # rename the country column name
+        df.rename(columns={"location":"country"}, inplace=True)
+        df["country"] = df["country"].astype("category")
 
-    # write data to database
-    write_data_to_db(df=df, table_name="daily_hospital_admissions", schema="fact")
+        # keep only the rows whose foreign keys exist in the dimensions
+        df = df[_foreign_key_mask(df, generate_calendar, generate_countries)]
 
-@asset(deps=[generate_calendar, generate_countries])
-def pull_excess_mortality() -> None:
-    """
-    Get the historical data of COVID-19 excess mortality by country.
-    """
+        # write data to database
+        write_data_to_db(df=df, table_name=table_name, schema="fact")
 
-    # read data from api
-    url = "https://covid.ourworldindata.org/data/internal/megafile--excess-mortality.json"
-    df = pd.read_json(url)
+        # record the downloaded file to audit the cache
+        return MaterializeResult(metadata=source_metadata)
 
-    # rename the country column name
-    df.rename(columns={"location":"country"}, inplace=True)
+    return _pull_asset
+
+pull_deaths = _make_pull_asset(
+    name="pull_deaths",
+    url="https://covid.ourworldindata.org/data/internal/megafile--deaths.json",
+    table_name="daily_deaths",
+    description="Get the historical data of COVID-19 deaths by country.",
+    drop_continent=True
+)
 
-    # read dimension tables
-    df_date = db_run_query("select distinct [date] from dim.calendar")
-    df_country = db_run_query("select distinct [country] from dim.country")
+pull_vaccinations = _make_pull_asset(
+    name="pull_vaccinations",
+    url="https://covid.ourworldindata.org/data/internal/megafile--vaccinations.json",
+    table_name="daily_vaccinations",
+    description="Get the historical data of COVID-19 vaccinations by country."
+)
 
-    # inner join to make sure foreign keys
-    df = (
-        df
-        .merge(df_date)
-        .merge(df_country)
-    )
+pull_hospital_admissions = _make_pull_asset(
+    name="pull_hospital_admissions",
+    url="https://covid.ourworldindata.org/data/internal/megafile--hospital-admissions.json",
+    table_name="daily_hospital_admissions",
+    description="Get the historical data of COVID-19 hospital patients and admissions by country."
+)
 
-    # write data to database
-    write_data_to_db(df=df, table_name="daily_excess_mortality", schema="fact")
\ No newline at end of file
+pull_excess_mortality = _make_pull_asset(
+    name="pull_excess_mortality",
+    url="https://covid.ourworldindata.org/data/internal/megafile--excess-mortality.json",
+    table_name="daily_excess_mortality",
+    description="Get the historical data of COVID-19 excess mortality by country."
+)
@@ -1 +1,229 @@
+import io
+import json
+from types import SimpleNamespace
 
+import ijson
+import pandas as pd
+import pyarrow as pa
+import pytest
+import requests
+
+from covid19 import assets
+from covid19.assets import _foreign_key_mask
+
+URL = "https://covid.ourworldindata.org/data/internal/megafile--test.json"
+
+
+def test_foreign_key_mask_matches_dates_across_units():
+    # the api yields second timestamps, the database nanosecond ones
+    df = pd.DataFrame({
+        "date": pd.Series(pd.to_datetime(["2020-01-01", "2020-01-02", "2020-01-03"]))
+        .astype(pd.ArrowDtype(pa.timestamp("s"))),
+        "country": pd.Series(["A", "A", "B"], dtype="category"),
+    })
+    df_date = pd.DataFrame({
+        "date": pd.Series(pd.to_datetime(["2020-01-01", "2020-01-03"]))
+        .astype(pd.ArrowDtype(pa.timestamp("ns"))),
+    })
+    df_country = pd.DataFrame({"country": pd.Series(["A"], dtype="category")})
+
+    mask = _foreign_key_mask(df, df_date, df_country)
+
+    assert mask.tolist() == [True, False, False]
+
+
+class FakeResponse:
+    """
+    Stand-in for a streamed requests.Response, items of chunks that are exceptions are raised.
+    """
+
+    def __init__(self, status_code=200, headers=None, chunks=()):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.closed = False
+        self._chunks = chunks
+
+    def iter_content(self, chunk_size=None):
+        for chunk in self._chunks:
+            if self.closed:
+                raise requests.ConnectionError("connection closed")
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(self.status_code)
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+@pytest.fixture
+def owid(tmp_path, monkeypatch):
+    """
+    Serve queued fake responses to _read_json_url from a temporary cache.
+    """
+    responses = []
+    sent_headers = []
+
+    def fake_get(url, headers=None, **kwargs):
+        sent_headers.append(headers)
+        return responses.pop(0)
+
+    monkeypatch.setattr(assets, "OWID_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(assets.requests, "get", fake_get)
+    return SimpleNamespace(cache=tmp_path, responses=responses, sent_headers=sent_headers)
+
+
+NDJSON = (
+    b'{"location":"A","date":"2020-01-01","new_cases":1}\n'
+    b'{"location":"B","date":"2020-01-02","new_cases":null}\n'
+)
+
+
+def test_read_json_url_parses_and_caches_the_download(owid):
+    owid.responses.append(FakeResponse(headers={"ETag": '"v1"'}, chunks=[NDJSON[:30], NDJSON[30:]]))
+
+    df, metadata = assets._read_json_url(URL)
+
+    assert df["location"].tolist() == ["A", "B"]
+    assert df["new_cases"].dtype == pd.ArrowDtype(pa.int64())
+    assert metadata["cache_hit"] is False
+    assert metadata["etag"] == '"v1"'
+    assert sorted(path.suffix for path in owid.cache.iterdir()) == [".json", ".json"]
+
+
+def test_read_json_url_discards_a_download_that_fails_to_parse(owid):
+    owid.responses.append(FakeResponse(headers={"ETag": '"v1"'}, chunks=[NDJSON]))
+    assets._read_json_url(URL)
+    cached_files = {path.name: path.read_bytes() for path in owid.cache.iterdir()}
+
+    response = FakeResponse(headers={"ETag": '"v2"'}, chunks=[b'[{"location":"A"}, oops', b"]"])
+    owid.responses.append(response)
+    with pytest.raises(ijson.JSONError):
+        assets._read_json_url(URL)
+
+    # the download is aborted, and the previous cache entry survives untouched
+    assert response.closed
+    assert {path.name: path.read_bytes() for path in owid.cache.iterdir()} == cached_files
+
+
+def test_read_json_url_raises_a_download_error_after_a_truncated_parse(owid):
+    # the parser sees a complete first line, then the end of the stream
+    owid.responses.append(FakeResponse(chunks=[NDJSON[:51], requests.ConnectionError("reset")]))
+
+    with pytest.raises(requests.ConnectionError):
+        assets._read_json_url(URL)
+
+    assert list(owid.cache.iterdir()) == []
+
+
+@pytest.mark.parametrize(
+    "body",
+    [NDJSON, json.dumps([{"location": "A", "date": "2020-01-01"}] * 3).encode()],
+    ids=["lines", "records"],
+)
+def test_read_json_url_raises_a_download_error_cut_mid_record(owid, body):
+    owid.responses.append(FakeResponse(chunks=[body[:40], requests.ConnectionError("reset")]))
+
+    with pytest.raises(requests.ConnectionError) as exc_info:
+        assets._read_json_url(URL)
+
+    # the truncated parse is kept as the context of the download error
+    assert exc_info.value.__cause__ is not None
+    assert list(owid.cache.iterdir()) == []
+
+
+def test_read_json_url_reuses_the_cache_when_not_modified(owid):
+    owid.responses.append(FakeResponse(headers={"ETag": '"v1"', "Last-Modified": "Wed, 01 Jan 2020"}, chunks=[NDJSON]))
+    assets._read_json_url(URL)
+
+    owid.responses.append(FakeResponse(status_code=304))
+    df, metadata = assets._read_json_url(URL)
+
+    assert owid.sent_headers[-1] == {"If-None-Match": '"v1"', "If-Modified-Since": "Wed, 01 Jan 2020"}
+    assert metadata["cache_hit"] is True
+    assert df["location"].tolist() == ["A", "B"]
+
+
+def test_read_json_url_replaces_the_cache_when_modified(owid):
+    owid.responses.append(FakeResponse(headers={"ETag": '"v1"'}, chunks=[NDJSON]))
+    assets._read_json_url(URL)
+
+    changed = b'{"location":"C","date":"2020-01-03","new_cases":3}\n'
+    owid.responses.append(FakeResponse(headers={"ETag": '"v2"'}, chunks=[changed]))
+    df, metadata = assets._read_json_url(URL)
+
+    headers_file, = owid.cache.glob("*.headers.json")
+    assert json.loads(headers_file.read_text()) == {"ETag": '"v2"'}
+    assert metadata["cache_hit"] is False
+    assert df["location"].tolist() == ["C"]
+
+
+def test_read_json_array_promotes_columns_across_batches(monkeypatch):
+    monkeypatch.setattr(assets, "JSON_BATCH_SIZE", 2)
+    records = [
+        {"location": "A", "date": "2020-01-01", "new_cases": 1},
+        {"location": "A", "date": "2020-01-02", "new_cases": 2},
+        {"location": "B", "date": "2020-01-01", "new_cases": None, "new_tests": None},
+        {"location": "B", "date": "2020-01-02", "new_cases": None, "new_tests": None},
+        {"location": "C", "date": "2020-01-01", "new_cases": 2.5, "new_tests": 7},
+    ]
+    stream = io.BufferedReader(io.BytesIO(json.dumps(records).encode()))
+
+    table = assets._read_json_array(stream)
+
+    assert table.num_rows == 5
+    assert table.schema.field("date").type == pa.timestamp("s")
+    assert table.schema.field("new_cases").type == pa.float64()
+    assert table["new_cases"].to_pylist() == [1, 2, None, None, 2.5]
+    assert table["new_tests"].to_pylist() == [None, None, None, None, 7]
+
+
+@pytest.mark.parametrize(
+    "head, layout",
+    [
+        (b' [{"location":"A"}]', "records"),
+        (b'{"location":"A","date":"2020-01-01"}\n{"location":"B"', "lines"),
+        (b'{"location":["A","B"],"date":["2020-01-01"', "columns"),
+        (b'{"location":{"0":"A"},"date":{"0":"2020-01-01"', "columns"),
+        (b"  ", None),
+        (b'{"loc', None),
+        (b'{"location":"A', None),
+    ],
+)
+def test_json_layout_tells_the_file_layout_apart(head, layout):
+    assert assets._json_layout(head) == layout
+
+
+def test_json_layout_rejects_other_json():
+    with pytest.raises(ValueError):
+        assets._json_layout(b'"location"')
+
+
+def test_read_json_stream_keeps_arrow_dtypes_for_column_oriented_json():
+    body = b'{"location":["A","B"],"date":["2020-01-01","2020-01-02"],"new_cases":[1,null]}'
+
+    df = assets._read_json_stream(io.BufferedReader(io.BytesIO(body)))
+
+    assert df["location"].tolist() == ["A", "B"]
+    assert df["new_cases"].dtype == pd.ArrowDtype(pa.int64())
+    assert df["new_cases"].isna().tolist() == [False, True]
+    assert df["date"].dtype == pd.ArrowDtype(pa.timestamp("ns"))
+
+
+def test_read_json_url_tells_the_layout_from_a_head_split_across_chunks(owid):
+    body = b'{"location":["A","B"],"date":["2020-01-01","2020-01-02"],"new_cases":[1,null]}'
+    owid.responses.append(FakeResponse(chunks=[body[:5], body[5:14], body[14:]]))
+
+    df, _ = assets._read_json_url(URL)
+
+    assert df["location"].tolist() == ["A", "B"]
+    assert df["new_cases"].dtype == pd.ArrowDtype(pa.int64())
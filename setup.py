@@ -5,7 +5,8 @@ setup(
     packages=find_packages(exclude=["covid19_tests"]),
     install_requires=[
         "dagster",
-        "dagster-cloud"
+        "dagster-cloud",
+        "ijson"
     ],
     extras_require={"dev": ["dagster-webserver", "pytest"]},
 )